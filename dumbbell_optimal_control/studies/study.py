@@ -1,13 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
 from typing import Protocol
 import os
+import re
 
 from bioptim import Solution
 import numpy as np
-from matplotlib import pyplot as plt
 
 from .study_configuration import StudyConfiguration
 from .ocp import DataType
 
+_LATEX_PREAMBLE = (
+    r"\usepackage{amssymb}"
+    r"\usepackage{siunitx}"
+    r"\newcommand{\condition}{C/}"
+    r"\newcommand{\noFatigue}{\varnothing}"
+    r"\newcommand{\qcc}{4\textsubscript{CC}}"
+    r"\newcommand{\pe}{P\textsubscript{E}}"
+    r"\newcommand{\taupm}{\tau^{\pm}}"
+    r"\newcommand{\tauns}{\tau^{\times}}"
+    r"\newcommand{\condTauNf}{{\condition}{\tau}{\noFatigue}}"
+    r"\newcommand{\condTaupm}{{\condition}{\taupm}{}}"
+    r"\newcommand{\condTaupmQcc}{{\condition}{\taupm}{\qcc}}"
+    r"\newcommand{\condTaupmPe}{{\condition}{\taupm}{\pe}}"
+    r"\newcommand{\condTauns}{{\condition}{\tauns}{}}"
+    r"\newcommand{\condTaunsNf}{{\condition}{\tauns}{\noFatigue}}"
+    r"\newcommand{\condTaunsQcc}{{\condition}{\tauns}{\qcc}}"
+    r"\newcommand{\condTaunsPe}{{\condition}{\tauns}{\pe}}"
+    r"\newcommand{\condAlpha}{{\condition}{\alpha}{}}"
+    r"\newcommand{\condAlphaNf}{{\condition}{\alpha}{\noFatigue}}"
+    r"\newcommand{\condAlphaQcc}{{\condition}{\alpha}{\qcc}}"
+    r"\newcommand{\condAlphaPe}{{\condition}{\alpha}{\pe}}"
+)
+
+_RMSE_EXPONENT = re.compile(r"e([+-])0*(\d+)$")
+
+
+def _rmse_exponent_to_latex(match: re.Match) -> str:
+    sign, digits = match.groups()
+    if digits == "0":
+        return ""
+    return "$\\times 10^{{" + ("-" if sign == "-" else "") + digits + "}}$"
+
+
+def _perform_condition(condition):
+    # Module-level so ProcessPoolExecutor can pickle it
+    return condition.perform()
+
 
 class Conditions(Protocol):
     name: str
@@ -19,32 +57,56 @@ class Study:
         self.name = conditions.name
         self._has_run: bool = False
         self._plots_are_prepared: bool = False
+        self._results_dir: str = None
         self.conditions: StudyConfiguration = conditions.value
         self.solution: list[Solution, ...] = []
 
-    def run(self):
-        for condition in self.conditions.studies:
-            self.solution.append(condition.perform())
+    def run(self, n_processes: int = 1):
+        """
+        Solve all the conditions of the study, the OCPs being independent they can be dispatched
+        to a process pool
+
+        Parameters
+        ----------
+        n_processes: int
+            The number of conditions to solve concurrently. The default (1) keeps the sequential
+            behavior; the conditions must be picklable to use more
+        """
+        studies = self.conditions.studies
+        if n_processes > 1:
+            with ProcessPoolExecutor(max_workers=min(n_processes, len(studies))) as executor:
+                # map (and not as_completed) so the solutions keep the order of the conditions
+                self.solution = list(executor.map(_perform_condition, studies))
+        else:
+            self.solution = [condition.perform() for condition in studies]
         self._has_run = True
 
     def print_results(self):
-        print("Number of iterations")
-        for study, sol in zip(self.conditions.studies, self.solution):
-            print(f"\t{study.name} = {sol.iterations}")
-
-        print("Total time to optimize")
+        # Collect the three blocks in a single pass and write them with a single print
+        iterations = []
+        total_times = []
+        mean_times = []
         for study, sol in zip(self.conditions.studies, self.solution):
-            print(f"\t{study.name} = {sol.real_time_to_optimize:0.3f} second")
-
-        print("Mean time per iteration to optimize")
-        for study, sol in zip(self.conditions.studies, self.solution):
-            print(f"\t{study.name} = {sol.real_time_to_optimize / sol.iterations:0.3f} second")
+            iterations.append(f"\t{study.name} = {sol.iterations}")
+            total_times.append(f"\t{study.name} = {sol.real_time_to_optimize:0.3f} second")
+            mean_times.append(f"\t{study.name} = {sol.real_time_to_optimize / sol.iterations:0.3f} second")
+
+        print(
+            "Number of iterations\n"
+            + "\n".join(iterations)
+            + "\nTotal time to optimize\n"
+            + "\n".join(total_times)
+            + "\nMean time per iteration to optimize\n"
+            + "\n".join(mean_times)
+        )
 
     def generate_latex_table(self):
         if not self._has_run:
             raise RuntimeError("run() must be called before generating the latex table")
 
-        table = (
+        # Accumulate the table in a list and join once at the end, instead of quadratic
+        # string concatenation
+        parts = [
             f"\\documentclass{{article}}\n"
             f"\n"
             f"\\usepackage{{amsmath}}\n"
@@ -103,29 +165,37 @@ class Study:
             f"\\bfseries\\makecell[c]{{Temps moyen\\\\par itération\\\\(s/iteration)}} & "
             f"\\bfseries\\makecell[c]{{$\\sum\\text{{\\rmse{{}}}}$\\\\pour $\\q$\\\\(rad)}}\\\\ \n"
             f"   \\hline\n"
-        )
+        ]
+
+        # Compute the RMSE of every study against its reference in one broadcast pass per
+        # reference. Only the first min(studies, solutions, rmse_index) rows are reported (as the
+        # zip below truncates) and references pointing outside the solutions are left at 0, which
+        # prints as "---"
+        all_q = np.stack([getattr(sol, DataType.STATES.value)["q"] for sol in self.solution])
+        n_rows = min(len(self.conditions.studies), len(self.solution), len(self.conditions.rmse_index))
+        rmse_index = self.conditions.rmse_index[:n_rows]
+        rmse_sums = np.zeros(n_rows)
+        for idx_ref in set(rmse_index):
+            if idx_ref >= len(self.solution):
+                continue
+            to_compute = [i for i, idx in enumerate(rmse_index) if idx == idx_ref]
+            e = all_q[idx_ref][np.newaxis] - all_q[to_compute]
+            rmse_sums[to_compute] = (np.linalg.norm(e, axis=2) / np.sqrt(all_q.shape[2])).sum(axis=1)
 
         all_has_converged = True
-        for study, sol, rmse_index in zip(self.conditions.studies, self.solution, self.conditions.rmse_index):
-            rmse = np.sum(self._rmse(DataType.STATES, "q", rmse_index, sol))
-            rmse_str = f"{rmse:0.3e}" if rmse != 0 else "---"
-            if rmse_str.find("e") >= 0:
-                rmse_str = rmse_str.replace("e", "$\\times 10^{{")
-                rmse_str += "}}$"
-                rmse_str = rmse_str.replace("+0", "")
-                rmse_str = rmse_str.replace("-0", "-")
-                rmse_str = rmse_str.replace("$\\times 10^{{0}}$", "")
+        for study, sol, rmse in zip(self.conditions.studies, self.solution, rmse_sums):
+            rmse_str = _RMSE_EXPONENT.sub(_rmse_exponent_to_latex, f"{rmse:0.3e}") if rmse != 0 else "---"
 
             nlp = study.ocp.nlp[0]
             n_var = nlp.ns * nlp.controls.shape + (nlp.ns + 1) * nlp.states.shape
-            n_constraints = nlp.ns * study.ocp.nlp[0].states.shape + sum([g.bounds.shape[0] for g in nlp.g])
+            n_constraints = nlp.ns * nlp.states.shape + sum(g.bounds.shape[0] for g in nlp.g)
 
             study_name = study.name
             if sol.iterations == study.solver.max_iter:
                 study_name += "*"
                 all_has_converged = False
 
-            table += (
+            parts.append(
                 f"   {study_name} "
                 f"& {n_var}/{n_constraints} "
                 f"& {sol.iterations} "
@@ -133,16 +203,17 @@ class Study:
                 f"& {sol.real_time_to_optimize / sol.iterations:0.3f} "
                 f"& {rmse_str} \\\\\n"
             )
-        table += f"   \\hline\n" f"  \\end{{tabular}}\n"
+        parts.append(f"   \\hline\n" f"  \\end{{tabular}}\n")
 
         if not all_has_converged:
-            table += f"  \\begin{{tablenotes}}\n"
-            table += f"   \\item * Condition n'ayant pas convergé (maximum d'itérations atteint)\n"
-            table += f"  \\end{{tablenotes}}\n"
+            parts.append(f"  \\begin{{tablenotes}}\n")
+            parts.append(f"   \\item * Condition n'ayant pas convergé (maximum d'itérations atteint)\n")
+            parts.append(f"  \\end{{tablenotes}}\n")
 
-        table += f" \\end{{threeparttable}}\n"
-        table += f"\\end{{table}}\n\n"
-        table += f"\\end{{document}}\n"
+        parts.append(f" \\end{{threeparttable}}\n")
+        parts.append(f"\\end{{table}}\n\n")
+        parts.append(f"\\end{{document}}\n")
+        table = "".join(parts)
 
         save_path = f"{self.prepare_and_get_results_dir()}/results.tex"
 
@@ -156,55 +227,35 @@ class Study:
             study.ocp.save(sol, file_path=f"{self.prepare_and_get_results_dir()}/{study.save_name}", stand_alone=True)
 
     def prepare_and_get_results_dir(self):
-        try:
-            os.mkdir("results")
-        except FileExistsError:
-            pass
-
-        try:
-            os.mkdir(f"results/{self.name}")
-        except FileExistsError:
-            pass
-        return f"results/{self.name}"
+        if self._results_dir is None:
+            path = f"results/{self.name}"
+            os.makedirs(path, exist_ok=True)
+            self._results_dir = path
+        return self._results_dir
 
     def prepare_plot_data(self, data_type: DataType, key: str, font_size: int = 20):
+        from matplotlib import pyplot as plt  # Imported here so plot-free workflows do not pay for it
+
         if not self._has_run:
             raise RuntimeError("run() must be called before plotting the results")
 
-        n_plots = getattr(self.solution[0], data_type.value)[key].shape[0]
-        if sum(np.array([getattr(sol, data_type.value)[key].shape[0] for sol in self.solution]) != n_plots) != 0:
+        data_attr = data_type.value
+        n_plots = getattr(self.solution[0], data_attr)[key].shape[0]
+        if any(getattr(sol, data_attr)[key].shape[0] != n_plots for sol in self.solution):
             raise RuntimeError("All the models must have the same number of dof to be plotted")
         t = np.linspace(self.solution[0].phase_time[0], self.solution[0].phase_time[1], self.solution[0].ns[0] + 1)
 
         plot_options = self.conditions.plot_options
         studies = self.conditions.studies
+        scale = 180 / np.pi if plot_options.to_degrees else 1
+
+        # Mutating rcParams triggers a revalidation, so set them once for all the figures
+        plt.rcParams["text.usetex"] = True
+        plt.rcParams["text.latex.preamble"] = _LATEX_PREAMBLE
 
         for i in range(n_plots):
             fig = plt.figure()
             fig.set_size_inches(16, 9)
-            plt.rcParams["text.usetex"] = True
-            plt.rcParams["text.latex.preamble"] = (
-                r"\usepackage{amssymb}"
-                r"\usepackage{siunitx}"
-                r"\newcommand{\condition}{C/}"
-                r"\newcommand{\noFatigue}{\varnothing}"
-                r"\newcommand{\qcc}{4\textsubscript{CC}}"
-                r"\newcommand{\pe}{P\textsubscript{E}}"
-                r"\newcommand{\taupm}{\tau^{\pm}}"
-                r"\newcommand{\tauns}{\tau^{\times}}"
-                r"\newcommand{\condTauNf}{{\condition}{\tau}{\noFatigue}}"
-                r"\newcommand{\condTaupm}{{\condition}{\taupm}{}}"
-                r"\newcommand{\condTaupmQcc}{{\condition}{\taupm}{\qcc}}"
-                r"\newcommand{\condTaupmPe}{{\condition}{\taupm}{\pe}}"
-                r"\newcommand{\condTauns}{{\condition}{\tauns}{}}"
-                r"\newcommand{\condTaunsNf}{{\condition}{\tauns}{\noFatigue}}"
-                r"\newcommand{\condTaunsQcc}{{\condition}{\tauns}{\qcc}}"
-                r"\newcommand{\condTaunsPe}{{\condition}{\tauns}{\pe}}"
-                r"\newcommand{\condAlpha}{{\condition}{\alpha}{}}"
-                r"\newcommand{\condAlphaNf}{{\condition}{\alpha}{\noFatigue}}"
-                r"\newcommand{\condAlphaQcc}{{\condition}{\alpha}{\qcc}}"
-                r"\newcommand{\condAlphaPe}{{\condition}{\alpha}{\pe}}"
-            )
 
             ax = plt.axes()
             if plot_options.title:
@@ -216,8 +267,8 @@ class Study:
             ax.tick_params(axis="both", labelsize=font_size)
 
             for sol, options in zip(self.solution, plot_options.options):
-                data = getattr(sol, data_type.value)[key][i, :]
-                data *= 180 / np.pi if plot_options.to_degrees else 1
+                # Scale out of place: an in-place *= would mutate the cached solution data
+                data = getattr(sol, data_attr)[key][i, :] * scale
                 plt.plot(t, data, **options)
 
             if plot_options.legend_indices is not None:
@@ -237,12 +288,11 @@ class Study:
         data = getattr(sol, data_type.value)[key]
 
         e = data_ref - data
-        se = e**2
-        mse = np.sum(se, axis=1) / data_ref.shape[1]
-        rmse = np.sqrt(mse)
-        return rmse
+        return np.linalg.norm(e, axis=1) / np.sqrt(data_ref.shape[1])
 
     def plot(self):
+        from matplotlib import pyplot as plt
+
         if not self._plots_are_prepared:
             raise RuntimeError("At least one plot should be prepared before calling plot")
 
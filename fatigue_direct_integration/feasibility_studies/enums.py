@@ -11,6 +11,7 @@ class PlotOptions:
         supplementary_legend_title: str = None,
         options: tuple[dict, ...] = None,
         save_name: str = None,
+        save_formats: tuple[str, ...] = ("png", "pdf", "eps"),
         xlim: tuple[float, float] = None,
         ylim: tuple[float, float] = None,
         keep_frame: bool = True,
@@ -20,6 +21,7 @@ class PlotOptions:
         self.legend_title = legend_title
         self.options = options
         self.save_name = save_name
+        self.save_formats = save_formats
         self.supplementary_legend = supplementary_legend
         self.supplementary_legend_title = supplementary_legend_title
         self.xlim = xlim
@@ -2,13 +2,11 @@ import os
 from typing import Any
 
 import numpy as np
-from matplotlib import pyplot as plt
 from time import perf_counter
-from scipy import integrate
 
 from .enums import Integrator
 from .study_configuration import StudyConfiguration
-from .fatigue_model import FatigueModel
+from .fatigue_model import FatigueModel, _xia_dynamics, njit
 
 
 class Result:
@@ -17,12 +15,45 @@ class Result:
         self.y = y
 
 
+def _rk4_core(x0, h, targets, targets_mid, targets_end, LD, LR, F, R, S):
+    """
+    RK4 walk over the precomputed target loads, with the dynamics inlined as pure float algebra
+    so the whole loop can be jit-compiled
+    """
+    n = targets.shape[0]
+    y = np.empty((3, n))
+    ma, mr, mf = x0[0], x0[1], x0[2]
+    half_h = h / 2
+    sixth_h = h / 6
+    for i in range(n):
+        a1, r1, f1 = _xia_dynamics(targets[i], ma, mr, mf, LD, LR, F, R, S)
+        a2, r2, f2 = _xia_dynamics(
+            targets_mid[i], ma + half_h * a1, mr + half_h * r1, mf + half_h * f1, LD, LR, F, R, S
+        )
+        a3, r3, f3 = _xia_dynamics(
+            targets_mid[i], ma + half_h * a2, mr + half_h * r2, mf + half_h * f2, LD, LR, F, R, S
+        )
+        a4, r4, f4 = _xia_dynamics(targets_end[i], ma + h * a3, mr + h * r3, mf + h * f3, LD, LR, F, R, S)
+        ma += sixth_h * (a1 + 2 * a2 + 2 * a3 + a4)
+        mr += sixth_h * (r1 + 2 * r2 + 2 * r3 + r4)
+        mf += sixth_h * (f1 + 2 * f2 + 2 * f3 + f4)
+        y[0, i] = ma
+        y[1, i] = mr
+        y[2, i] = mf
+    return y
+
+
+if njit is not None:
+    _rk4_core = njit(cache=True, fastmath=True)(_rk4_core)
+
+
 class FatigueIntegrator:
     def __init__(self, study_configuration: StudyConfiguration):
         self.study = study_configuration
         self._has_run: bool = False
         self._results: list[list[Result, ...], ...] = []
         self._performing_time: list[list[float, ...], ...] = []
+        self._results_dir: str = None
         self.axes = None
 
     @property
@@ -39,46 +70,107 @@ class FatigueIntegrator:
         """
 
         t_eval = self.study.t
-        for _ in range(self.study.repeat):
-            self._results.append([])
-            self._performing_time.append([])
-            for fatigue in self.study.fatigue_models:
+        h = t_eval[1] - t_eval[0]
+
+        # The target function is deterministic over a fixed time vector, so sample it once for all
+        # the models and repeats instead of at every RK4 stage
+        target_function = self.study.target_function
+        targets = target_function.vectorized(t_eval)
+        targets_mid = target_function.vectorized(t_eval + h / 2)
+        targets_end = target_function.vectorized(t_eval + h)
+
+        n_models = len(self.study.fatigue_models)
+        self._results = [[None] * n_models for _ in range(self.study.repeat)]
+        self._performing_time = [[0.0] * n_models for _ in range(self.study.repeat)]
+        for repeat in range(self.study.repeat):
+            for k, fatigue in enumerate(self.study.fatigue_models):
                 starting_time = perf_counter()
                 if fatigue.integrator == Integrator.RK45:
                     out = self.rk45(t_eval, fatigue)
                 elif fatigue.integrator == Integrator.RK4:
-                    out = self.rk4(t_eval, fatigue)
+                    out = self.rk4(t_eval, fatigue, targets, targets_mid, targets_end)
                 else:
                     raise ValueError("Wrong selection of integrator")
-                self._performing_time[-1].append(perf_counter() - starting_time)
+                self._performing_time[repeat][k] = perf_counter() - starting_time
 
-                self._results[-1].append(out)
+                self._results[repeat][k] = out
 
         self._has_run = True
 
     def rk45(self, t_eval, fatigue) -> Result:
+        from scipy import integrate  # Imported here so integration-free workflows do not pay for it
+
         t_span = (self.study.t[0], self.study.t[-1])
         x0 = fatigue.initial_guess
-        out: Any = integrate.solve_ivp(lambda t, x: self._dynamics(t, x, fatigue), t_span, x0, t_eval=t_eval)
-        return Result(out.t, out.y)
 
-    def rk4(self, t_eval, fatigue) -> Result:
-        def next_step(t0, x):
-            k1 = self._dynamics(t0, x, fatigue)
-            k2 = self._dynamics(t0 + h / 2, x + h / 2 * k1, fatigue)
-            k3 = self._dynamics(t0 + h / 2, x + h / 2 * k2, fatigue)
-            k4 = self._dynamics(t0 + h, x + h * k3, fatigue)
-            return x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        # Bind everything the RHS needs as default arguments so each of the thousands of calls
+        # solve_ivp performs resolves to locals instead of a chain of attribute lookups
+        def fun(
+            t,
+            x,
+            target=self.study.target_function.function,
+            scaling=fatigue.scaling,
+            apply_dynamics=fatigue.apply_dynamics,
+        ):
+            return apply_dynamics(target(t) / scaling, x)
 
-        h = self.study.t[1] - self.study.t[0]
-        y = np.ndarray((3, self.study.t.shape[0]))
-        x0 = fatigue.initial_guess
-        for i, t in enumerate(t_eval):
-            y[:, i] = next_step(t, x0)
-            x0 = y[:, i]
+        out: Any = integrate.solve_ivp(fun, t_span, x0, t_eval=t_eval)
+        return Result(out.t, out.y)
+
+    def rk4(self, t_eval, fatigue, targets=None, targets_mid=None, targets_end=None) -> Result:
+        h = t_eval[1] - t_eval[0]
+        half_h = h / 2
+        sixth_h = h / 6
+
+        # The target samples are normally precomputed once in perform(); sample them here only
+        # when rk4 is called on its own
+        target_function = self.study.target_function
+        if targets is None:
+            targets = target_function.vectorized(t_eval)
+        if targets_mid is None:
+            targets_mid = target_function.vectorized(t_eval + half_h)
+        if targets_end is None:
+            targets_end = target_function.vectorized(t_eval + h)
+
+        scaling = fatigue.scaling
+        targets = targets / scaling
+        targets_mid = targets_mid / scaling
+        targets_end = targets_end / scaling
+        x0 = np.asarray(fatigue.initial_guess, dtype=float)
+
+        core_parameters = fatigue.dynamics_core_parameters
+        if njit is not None and core_parameters is not None:
+            if self._dynamics_core_matches(fatigue, targets[0], x0, core_parameters):
+                return Result(t_eval, _rk4_core(x0, h, targets, targets_mid, targets_end, *core_parameters))
+
+        apply_dynamics = fatigue.apply_dynamics
+        y = np.empty((3, t_eval.shape[0]))
+        x = x0.copy()
+        stage = np.empty(3)
+        for i in range(t_eval.shape[0]):
+            k1 = apply_dynamics(targets[i], x)
+            np.multiply(k1, half_h, out=stage)
+            stage += x
+            k2 = apply_dynamics(targets_mid[i], stage)
+            np.multiply(k2, half_h, out=stage)
+            stage += x
+            k3 = apply_dynamics(targets_mid[i], stage)
+            np.multiply(k3, h, out=stage)
+            stage += x
+            k4 = apply_dynamics(targets_end[i], stage)
+            # Accumulate the weighted sum in place in k1, which is not reused afterwards
+            k2 += k3
+            k2 *= 2
+            k1 += k2
+            k1 += k4
+            k1 *= sixth_h
+            x += k1
+            y[:, i] = x
         return Result(t_eval, y)
 
     def plot_results(self, font_size: int = 20, maximized: bool = False):
+        from matplotlib import pyplot as plt  # Imported here so plot-free workflows do not pay for it
+
         fig = plt.figure()
         fig.set_size_inches(16, 9)
         # plt.rcParams["text.usetex"] = True
@@ -98,7 +190,7 @@ class FatigueIntegrator:
             self._add_result_to_plot(model, result, plot_options)
         plt.plot(
             self.study.t,
-            [self.study.target_function.function(t) * 100 for t in self.study.t],
+            self.study.target_function.vectorized(self.study.t) * 100,
             color="tab:blue",
             linewidth=4,
         )
@@ -139,9 +231,14 @@ class FatigueIntegrator:
             plt.get_current_fig_manager().window.showMaximized()
 
         if self.study.plot_options.save_name:
-            plt.savefig(f"{self.prepare_and_get_results_dir()}/{self.study.plot_options.save_name}.png", dpi=100)
-            plt.savefig(f"{self.prepare_and_get_results_dir()}/{self.study.plot_options.save_name}.pdf", format="pdf")
-            plt.savefig(f"{self.prepare_and_get_results_dir()}/{self.study.plot_options.save_name}.eps", format="eps")
+            results_dir = self.prepare_and_get_results_dir()
+            fig.canvas.draw()  # Render once; saving then only encodes to each requested format
+            for save_format in self.study.plot_options.save_formats:
+                fig.savefig(
+                    f"{results_dir}/{self.study.plot_options.save_name}.{save_format}",
+                    format=save_format,
+                    dpi=100 if save_format == "png" else None,
+                )
 
         plt.show()
 
@@ -151,10 +248,13 @@ class FatigueIntegrator:
 
         print(f"Individual integration time:")
         time = np.array(self._performing_time).T
-        for model, t in zip(self.study.fatigue_models, time):
+        means = time.mean(axis=1)
+        t_end = self.study.t[-1]
+        n_trials = time.shape[1]
+        for model, mean_time in zip(self.study.fatigue_models, means):
             print(
-                f"\t{type(model).__name__}: {np.mean(t) / self.study.t[-1]:1.3f} seconds "
-                f"per integrated second for {np.mean(t):1.3f} second total (mean of {t.shape[0]} trials)"
+                f"\t{type(model).__name__}: {mean_time / t_end:1.3f} seconds "
+                f"per integrated second for {mean_time:1.3f} second total (mean of {n_trials} trials)"
             )
 
     def print_rmse(self):
@@ -164,16 +264,14 @@ class FatigueIntegrator:
         if len(self.study.fatigue_models) != 2:
             raise RuntimeError("rmse must have exactly 2 models to be called")
 
-        if sum([False if m.rms_indices is None else True for m in self.study.fatigue_models]) != 2:
+        if not all(m.rms_indices is not None for m in self.study.fatigue_models):
             raise ValueError("rms_indices were not all provided in the study configuration")
 
         # Get aliases
         models = self.study.fatigue_models
 
         e = self._results[-1][0].y[models[0].rms_indices, :] - self._results[-1][1].y[models[1].rms_indices, :]
-        se = e**2
-        mse = np.sum(se, axis=1) / self.study.n_points
-        rmse = np.sqrt(mse)
+        rmse = np.linalg.norm(e, axis=1) / np.sqrt(self.study.n_points)
 
         table = f"The RMSE between {type(models[0]).__name__} and {type(models[1]).__name__} is {rmse}"
 
@@ -205,22 +303,37 @@ class FatigueIntegrator:
         print("Custom analyses written in the results folder")
 
     def prepare_and_get_results_dir(self):
-        try:
-            os.mkdir("results")
-        except FileExistsError:
-            pass
-
-        try:
-            os.mkdir(f"results/{self.study.name}")
-        except FileExistsError:
-            pass
-        return f"results/{self.study.name}"
+        if self._results_dir is None:
+            path = f"results/{self.study.name}"
+            os.makedirs(path, exist_ok=True)
+            self._results_dir = path
+        return self._results_dir
 
-    def _dynamics(self, t, x, fatigue):
-        return fatigue.apply_dynamics(self.study.target_function.function(t) / fatigue.scaling, x)
+    @staticmethod
+    def _dynamics_core_matches(fatigue: FatigueModel, target_load: float, x0: np.ndarray, core_parameters) -> bool:
+        """
+        Check the compiled kernel against the reference apply_dynamics before trusting it. The
+        initial state alone is not discriminating (the compartments usually sum to 1, zeroing the
+        stabilization term, and only one branch of the activation command is taken), so also probe
+        states where the sum differs from 1 and, at a 0.5 target load, where ma is below the target
+        with mr above and below the remaining capacity and where ma is above the target (recovery)
+        """
+        probes = (
+            (target_load, x0),
+            (0.5, np.array([0.1, 0.9, 0.15])),
+            (0.5, np.array([0.1, 0.2, 0.15])),
+            (0.5, np.array([0.9, 0.2, 0.15])),
+        )
+        for probe_load, x in probes:
+            k = _xia_dynamics(probe_load, x[0], x[1], x[2], *core_parameters)
+            if not np.allclose(k, fatigue.apply_dynamics(probe_load, x)):
+                return False
+        return True
 
     @staticmethod
     def _add_result_to_plot(model: FatigueModel, results: Result, plot_options: Any):
+        from matplotlib import pyplot as plt
+
         plt.stackplot(results.t, results.y * 100, colors=model.colors, alpha=0.4)
         if model.print_sum:
             if "color" not in plot_options:
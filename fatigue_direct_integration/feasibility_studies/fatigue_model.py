@@ -2,9 +2,40 @@ from bioptim import XiaFatigue, XiaFatigueStabilized, MichaudFatigue, EffortPerc
 from bioptim.dynamics.fatigue.muscle_fatigue import MuscleFatigue
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the integrator keeps the pure Python stepper
+    njit = None
+
 from .enums import Integrator, CustomAnalysis
 
 
+def _xia_dynamics(
+    target_load: float, ma: float, mr: float, mf: float, LD: float, LR: float, F: float, R: float, S: float
+) -> tuple:
+    """
+    Xia fatigue dynamics (https://doi.org/10.1016/j.jbiomech.2007.09.037) with the stabilization term
+    of factor S applied to the resting compartment (S = 0 recovers the original model). This mirrors
+    the bioptim implementation with only floats so it can be jit-compiled
+    """
+    if ma < target_load:
+        if mr > target_load - ma:
+            command = LD * (target_load - ma)
+        else:
+            command = LD * mr
+    else:
+        command = LR * (target_load - ma)
+    ma_dot = command - F * ma
+    mr_dot = -command + R * mf + S * (1 - ma - mr - mf)
+    mf_dot = F * ma - R * mf
+    return ma_dot, mr_dot, mf_dot
+
+
+if njit is not None:
+    _xia_dynamics = njit(cache=True, fastmath=True)(_xia_dynamics)
+
+
 class FatigueParameters:
     # according to https://doi.org/10.1016/j.jbiomech.2018.06.005
     # Elbow Parameters
@@ -51,6 +82,14 @@ class FatigueModel:
     def apply_dynamics(self, target_load: float, states: np.ndarray) -> np.ndarray:
         return np.array(self.model.apply_dynamics(target_load, *states))[:, 0]
 
+    @property
+    def dynamics_core_parameters(self) -> tuple:
+        """
+        The parameters to forward to the jit-compiled dynamics kernel (_xia_dynamics), or None if
+        no kernel matches the model
+        """
+        return None
+
     @property
     def scaling(self) -> float:
         return self.model.scaling
@@ -70,6 +109,10 @@ class Xia(FatigueModel):
             x0 = model.default_initial_guess()
         super(Xia, self).__init__(model, *args, x0=x0, **kwargs)
 
+    @property
+    def dynamics_core_parameters(self) -> tuple:
+        return self.model.LD, self.model.LR, self.model.F, self.model.R, 0.0
+
     @property
     def table_name(self):
         return type(self.model).__name__
@@ -89,6 +132,10 @@ class XiaStabilized(FatigueModel):
             x0 = model.default_initial_guess()
         super(XiaStabilized, self).__init__(model, *args, x0=x0, **kwargs)
 
+    @property
+    def dynamics_core_parameters(self) -> tuple:
+        return self.model.LD, self.model.LR, self.model.F, self.model.R, self.model.stabilization_factor
+
     @property
     def table_name(self):
         return type(self.model).__name__ + f"_S{self.model.stabilization_factor}"
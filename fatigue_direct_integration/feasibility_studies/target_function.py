@@ -30,6 +30,10 @@ class TargetFunctionInternal:
         np.random.seed(42)
         self.random_target = np.random.rand((int(self.t_end) + 1) * self.n_points + 1)
 
+    def vectorized(self, t: np.ndarray) -> np.ndarray:
+        """Evaluate the target function over a whole time vector at once"""
+        return np.fromiter((self.function(value) for value in t), dtype=float, count=t.shape[0])
+
     def target_up_to_end(self, t):
         return self.fixed_target
 